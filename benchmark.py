@@ -0,0 +1,106 @@
+# =================================================================================================
+#       Title:              benchmark.py
+#       Description:        This file compares running batch files through Session.run_batch
+#                           with and without the Optimizer and checks that both produce the
+#                           same results
+#
+#       Author(s):          Norlander, Robert       (Primary)
+#                           Koenigsfeld, Jarod      (Debugging)
+#                           Salamonska, Aleksandra  (Documentation)
+#
+#       Class:              CSC 330-100 Language Design and Implementation
+#       Date:               2024-04-28
+#       Version:            1.0
+# =================================================================================================
+import gc
+import random
+import sys
+import time
+import src.banking as banking
+
+REPEAT = 15
+
+# Generate a batch file resembling a day of postings: accounts are opened, then each account
+# receives a run of deposits (payroll, transfers) followed by withdrawals and balance checks
+# @param accounts: The number of accounts in the batch
+# @param seed: The seed of the random number generator
+# @return: The lines of the batch
+def generate_batch(accounts=200, seed=330):
+    rng = random.Random(seed)
+    identifiers = [f"AC{index:06d}" for index in range(accounts)]
+    lines = [
+        f"CREATE FIRSTNAME Customer LASTNAME Number BALANCE {rng.randint(0, 5000)} ACCOUNT {identifier}"
+        for identifier in identifiers
+    ]
+    for _ in range(20):
+        for identifier in rng.sample(identifiers, accounts // 2):
+            for _ in range(rng.randint(1, 8)):
+                lines.append(f"DEPOSIT {identifier} {rng.randint(1, 500)}.{rng.randint(0, 99):02d}")
+            lines.append(f"WITHDRAW {identifier} {rng.randint(1, 3000)}")
+            if rng.random() < 0.2:
+                lines.append(f"BALANCE {identifier}")
+    return lines
+
+# Time a function with the garbage collector collected beforehand and disabled while it runs,
+# so a collection triggered by earlier allocations cannot land inside the measurement
+# @param function: The function to time
+# @return: The elapsed time and the value returned by the function
+def timed(function):
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        value = function()
+        elapsed = time.perf_counter() - start
+    finally:
+        gc.enable()
+    return elapsed, value
+
+# Time only the optimize and interpret stages, on a program parsed by Session.build_program
+# @param lines: The lines of the batch
+# @param optimize: Run the Optimizer over the batch
+# @return: The elapsed time
+def measure_interpret(lines, optimize):
+    session = banking.Session("benchmark", random.Random(0))
+    program = session.build_program(lines)
+    elapsed, _ = timed(lambda: session.run_program(program, optimize))
+    return elapsed
+
+# Run the batch in a fresh session with Session.run_batch, so both modes parse the whole
+# batch first and only differ by the Optimizer pass
+# @param lines: The lines of the batch
+# @param optimize: Run the Optimizer over the batch
+# @return: The elapsed time, the results and the session statistics
+def measure(lines, optimize):
+    session = banking.Session("benchmark", random.Random(0))
+    elapsed, results = timed(lambda: session.run_batch(lines, optimize))
+    return elapsed, [str(result) for result in results], session.stats()
+
+batches = {"generated": generate_batch()}
+for path in sys.argv[1:]:
+    with open(path, "r") as file:
+        batches[path] = file.readlines()
+
+for name, lines in batches.items():
+    # Alternate runs without and with the Optimizer and keep the best time of each, so
+    # warm-up and machine noise affect both modes alike
+    best = {"batch": None, "optimized": None, "batch interpret": None, "optimized interpret": None}
+    for _ in range(REPEAT):
+        for optimize in (False, True):
+            mode = "optimized" if optimize else "batch"
+            elapsed, results, stats = measure(lines, optimize)
+            best[mode] = elapsed if best[mode] is None else min(best[mode], elapsed)
+            if optimize:
+                optimized_results, fused = results, stats["fused"]
+            else:
+                batch_results = results
+            elapsed = measure_interpret(lines, optimize)
+            key = f"{mode} interpret"
+            best[key] = elapsed if best[key] is None else min(best[key], elapsed)
+
+    print(f"{name}: {len(lines)} lines, {fused} statements fused")
+    print(f"\tend to end  without optimizer: {best['batch'] * 1000:8.2f} ms ({len(lines) / best['batch']:10.0f} lines/s)")
+    print(f"\tend to end  with optimizer:    {best['optimized'] * 1000:8.2f} ms ({len(lines) / best['optimized']:10.0f} lines/s)")
+    print(f"\tinterpret   without optimizer: {best['batch interpret'] * 1000:8.2f} ms")
+    print(f"\tinterpret   with optimizer:    {best['optimized interpret'] * 1000:8.2f} ms (including the optimizer pass)")
+    print(f"\tresults match: {batch_results == optimized_results}")
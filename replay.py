@@ -0,0 +1,28 @@
+# =================================================================================================
+#       Title:              replay.py
+#       Description:        This file replays a trace recorded with shell.py --record against a
+#                           fresh account table, checks the results and prints timing profiles
+#
+#       Author(s):          Norlander, Robert       (Primary)
+#                           Koenigsfeld, Jarod      (Debugging)
+#                           Salamonska, Aleksandra  (Documentation)
+#
+#       Class:              CSC 330-100 Language Design and Implementation
+#       Date:               2024-04-28
+#       Version:            1.0
+# =================================================================================================
+import sys
+import src.tracing as tracing
+
+if len(sys.argv) != 2:
+    print("Usage: python3 replay.py <trace file>")
+    exit(2)
+
+try:
+    report = tracing.replay(sys.argv[1])
+except tracing.TraceError as error:
+    print(error)
+    exit(2)
+
+print(report)
+exit(0 if report.ok() else 1)
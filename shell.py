@@ -13,31 +13,48 @@
 # =================================================================================================
 import sys
 import src.banking as banking
+import src.tracing as tracing
 
-# Check if a file is provided as an argument, if yes then read the file and execute the commands
-if len(sys.argv) > 1:
-    with open(sys.argv[1], 'r') as file:
-        for line in file:
-            result = banking.run(line)
-            if result:
-                print(result)
-    exit()
+# Check if the statements should be recorded to a trace file, e.g. --record session.trace
+args = sys.argv[1:]
+recorder = None
+run = banking.run
+if "--record" in args:
+    index = args.index("--record")
+    if index + 1 >= len(args):
+        print("Usage: python3 shell.py [--record <trace file>] [<filepath>]")
+        exit(2)
+    recorder = tracing.TraceRecorder(args[index + 1])
+    run = recorder.run
+    del args[index:index + 2]
 
-# Interactive shell
-print("Welcome to the banking shell\n")
-print("The following commands are available:")
-print("\t- CREATE FIRSTNAME <first name> LASTNAME <last name> {BALANCE <balance>} {ACCOUNT <account number>}")
-print("\t- DEPOSIT <account_number> <amount>")
-print("\t- WITHDRAW <account_number> <amount>")
-print("\t- BALANCE <account_number>")
-print("\t- exit")
+# Close the trace file however the shell exits (exit, end of file, Ctrl-D or Ctrl-C)
+# so every recorded statement is flushed
+try:
+    # Check if a file is provided as an argument, if yes then read the file and execute the commands
+    if len(args) > 0:
+        with open(args[0], 'r') as file:
+            for line in file:
+                result = run(line)
+                if result:
+                    print(result)
+        exit()
 
-text = ""
-while text != "exit":
-    text = input("banking > ")
-    result = banking.run(text)
-    if result:
-        print(result)
-    
+    # Interactive shell
+    print("Welcome to the banking shell\n")
+    print("The following commands are available:")
+    print("\t- CREATE FIRSTNAME <first name> LASTNAME <last name> {BALANCE <balance>} {ACCOUNT <account number>}")
+    print("\t- DEPOSIT <account_number> <amount>")
+    print("\t- WITHDRAW <account_number> <amount>")
+    print("\t- BALANCE <account_number>")
+    print("\t- exit")
 
-    
\ No newline at end of file
+    text = ""
+    while text != "exit":
+        text = input("banking > ")
+        result = run(text)
+        if result:
+            print(result)
+finally:
+    if recorder:
+        recorder.close()
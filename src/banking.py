@@ -16,6 +16,11 @@
 
 import re
 import os
+import sys
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 import random
 from dotenv import load_dotenv
@@ -88,6 +93,7 @@ KEYWORDS = [
     "ACCOUNT",
 ]
 ACCOUNT_NUMBER_FORMAT = "^[A-Z]{2}[0-9]{6}"
+NUMBER_TYPES = (TokenType.TT_INT, TokenType.TT_FLOAT)
 
 # =================================================================================================
 #    TOKEN
@@ -207,6 +213,7 @@ class Node:
 #    @param lastname: The last name of the account holder
 #    @param balance: The initial balance of the account
 #    @param account_identifier: The account identifier of the account
+#    @param rng: The random number generator used to build a missing account identifier
 # =================================================================================================
 class CreateNode(Node):
     def __init__(
@@ -215,10 +222,13 @@ class CreateNode(Node):
         lastname,
         balance=Token(TokenType.TT_INT, 0),
         account_identifier=None,
+        rng=random,
     ):
         self.firstname = firstname
         self.lastname = lastname
         self.account_identifier = account_identifier
+        self.rng = rng
+        self.generated_identifier = not account_identifier
         if not account_identifier:
             self.account_identifier = self.build_account_identifier()
         self.balance = balance
@@ -231,7 +241,7 @@ class CreateNode(Node):
             TokenType.TT_STR,
             self.firstname.value[0]
             + self.lastname.value[0]
-            + str(random.randint(100000, 999999)),
+            + str(self.rng.randint(100000, 999999)),
         )
 
     def __repr__(self):
@@ -288,14 +298,36 @@ class BalanceNode(Node):
     def __repr__(self):
         return f"BalanceNode({self.account_identifier})"
 
+# =================================================================================================
+#   DEPOSIT BATCH NODE
+#
+#   The DepositBatchNode class is used to represent a run of consecutive DEPOSIT statements
+#   to the same account merged by the Optimizer. The account is looked up and updated once,
+#   while the original deposits are kept in order to produce one result per statement.
+#
+#   @param account_identifier: The account identifier to deposit money into
+#   @param deposits: The DEPOSIT nodes of the run, in source order
+# =================================================================================================
+class DepositBatchNode(Node):
+    def __init__(self, account_identifier, deposits):
+        self.account_identifier = account_identifier
+        self.deposits = deposits
+
+    def __repr__(self):
+        return f"DepositBatchNode({self.account_identifier}, {self.deposits})"
+
 # =================================================================================================
 #   PARSER
 #
 #   The Parser class is used to parse the tokens and build the AST.
+#
+#   @param tokens: The tokens to parse
+#   @param rng: The random number generator used to build missing account identifiers
 # =================================================================================================
 class Parser:
-    def __init__(self, tokens):
+    def __init__(self, tokens, rng=random):
         self.tokens = tokens
+        self.rng = rng
         self.current_token = None
         self.index = -1
 
@@ -447,7 +479,57 @@ class Parser:
 
             self.advance()
 
-        return CreateNode(first_name, last_name, balance, account_identifier)
+        return CreateNode(first_name, last_name, balance, account_identifier, self.rng)
+
+# =================================================================================================
+#   OPTIMIZER
+#
+#   The Optimizer class is used to rewrite the statements between parsing and interpreting.
+#   It finds runs of consecutive DEPOSIT statements to the same account and merges each run
+#   into a DepositBatchNode. Any other statement ends a run, so WITHDRAW and BALANCE always
+#   see the balance left by every deposit before them. Deposits with a non numeric amount
+#   are never merged.
+# =================================================================================================
+class Optimizer:
+    def __init__(self):
+        self.fused_count = 0
+
+    # Optimize the statements
+    # @param statements: The statements to optimize
+    # @return: The optimized statements
+    def optimize(self, statements):
+        optimized = []
+        run = []
+        run_identifier = None
+        for statement in statements:
+            if type(statement) is DepositNode and statement.amount.type in NUMBER_TYPES:
+                account_identifier = statement.account_identifier.value
+                if account_identifier == run_identifier:
+                    run.append(statement)
+                    continue
+                if run:
+                    self.flush(run, optimized)
+                run = [statement]
+                run_identifier = account_identifier
+                continue
+            if run:
+                self.flush(run, optimized)
+                run = []
+                run_identifier = None
+            optimized.append(statement)
+        if run:
+            self.flush(run, optimized)
+        return optimized
+
+    # Append a run of deposits to the optimized statements, merged if it holds several deposits
+    # @param run: The run of DEPOSIT nodes to the same account
+    # @param optimized: The optimized statements to append to
+    def flush(self, run, optimized):
+        if len(run) > 1:
+            self.fused_count += len(run) - 1
+            optimized.append(DepositBatchNode(run[0].account_identifier, run))
+        else:
+            optimized.append(run[0])
 
 # =================================================================================================
 #    ACCOUNT TABLE
@@ -519,6 +601,25 @@ class Interpreter:
             return f"Deposit of ${node.amount.value} into account {node.account_identifier.value} successful"
         return "Account not found"
 
+    # Visit a DEPOSIT batch node and update the account balance once
+    # @param node: The DEPOSIT batch node
+    # @return: A list of strings indicating the result of every deposit of the batch
+    def visit_DepositBatchNode(self, node: DepositBatchNode) -> list[str]:
+        account_identifier = node.account_identifier.value
+        account = self.account_table.get_account(account_identifier)
+        if not account:
+            return ["Account not found"] * len(node.deposits)
+
+        # Add the amounts one by one so the balance matches separate deposits exactly
+        balance = account.balance.value
+        for deposit in node.deposits:
+            balance += deposit.amount.value
+        account.balance.value = balance
+        return [
+            f"Deposit of ${deposit.amount.value} into account {account_identifier} successful"
+            for deposit in node.deposits
+        ]
+
     # Visit a WITHDRAW node and update the account balance
     # @param node: The WITHDRAW node
     # @return: A string indicating the result of the withdrawal
@@ -547,12 +648,13 @@ class Interpreter:
 global_account_table = AccountTable()
 
 # =================================================================================================
-#    RUN
+#    LEX
 #
-#    The run function is used to run the banking system.
-#    @param stream: The source code to run
+#    The lex function is used to tokenize the source code.
+#    @param stream: The source code to tokenize
+#    @return: The tokens and an error if one occurred
 # =================================================================================================
-def run(stream):
+def lex(stream):
     # Initialize the lexer
     lexer = Lexer(stream)
 
@@ -561,25 +663,371 @@ def run(stream):
 
     # Return an error if one occurred
     if error:
-        return error
+        return [], error
     if os.getenv("DEBUG") == "1":
         print(tokens)
 
+    return tokens, None
+
+# =================================================================================================
+#    BUILD AST
+#
+#    The build_ast function is used to parse the tokens and build the AST.
+#    @param tokens: The tokens to parse
+#    @param rng: The random number generator used to build missing account identifiers
+#    @return: The AST and an error if one occurred
+# =================================================================================================
+def build_ast(tokens, rng=random):
     # Initialize the parser
-    parser = Parser(tokens)
+    parser = Parser(tokens, rng)
 
     # Parse the tokens and build the AST
     ast, error = parser.parse()
 
     # Return an error if one occurred
     if error:
-        return error
+        return [], error
     if os.getenv("DEBUG") == "1":
         print(ast)
 
+    return ast, None
+
+# =================================================================================================
+#    PARSE
+#
+#    The parse function is used to tokenize the source code and build the AST.
+#    @param stream: The source code to parse
+#    @param rng: The random number generator used to build missing account identifiers
+#    @return: The AST and an error if one occurred
+# =================================================================================================
+def parse(stream, rng=random):
+    tokens, error = lex(stream)
+    if error:
+        return [], error
+    return build_ast(tokens, rng)
+
+# =================================================================================================
+#    RUN
+#
+#    The run function is used to run the banking system.
+#    @param stream: The source code to run
+#    @param account_table: The account table to run against, the global one by default
+# =================================================================================================
+def run(stream, account_table=global_account_table):
+    ast, error = parse(stream)
+
+    # Return an error if one occurred
+    if error:
+        return error
+
     # Initialize the interpreter
-    interpreter = Interpreter(global_account_table)
+    interpreter = Interpreter(account_table)
 
     # Interpret the AST and execute the commands
     result = interpreter.interpret(ast)
     return result
+
+# =================================================================================================
+#    SESSION
+#
+#    The Session class is used to run the banking system for a single tenant.
+#    Every session owns its own account table and interpreter, so several
+#    bank books can be served from the same process without sharing state.
+#    A session also keeps throughput statistics for the statements it ran.
+#
+#    @param tenant_id: The identifier of the tenant owning the session
+#    @param rng: The random number generator used to build missing account identifiers,
+#                pass a seeded random.Random to make generated account numbers reproducible
+# =================================================================================================
+class Session:
+    def __init__(self, tenant_id=None, rng=None):
+        self.tenant_id = tenant_id
+        self.rng = rng if rng is not None else random.Random()
+        self.account_table = AccountTable()
+        self.interpreter = Interpreter(self.account_table)
+        self.optimizer = Optimizer()
+        self.lock = threading.RLock()
+        # Number of pool jobs using the session, a pinned session is never evicted
+        self.pin_count = 0
+        # The TraceRecorder attached to the session, every statement run goes through it
+        self.recorder = None
+        self.statement_count = 0
+        self.error_count = 0
+        self.elapsed = 0.0
+
+    # Run the source code against the account table of the session
+    # @param stream: The source code to run
+    # @return: The result of the statement or an error if one occurred
+    def run(self, stream):
+        if self.recorder is not None:
+            return self.recorder.run(stream)
+        result, ast, timings = self.execute(stream)
+        return result
+
+    # Run the source code and time the lexing, parsing and interpreting stages.
+    # This bypasses an attached recorder, use run() to have the statement recorded.
+    # @param stream: The source code to run
+    # @return: The result, the AST and a (lex, parse, interpret) tuple of nanoseconds
+    def execute(self, stream):
+        with self.lock:
+            ast = []
+            result = None
+            lex_start = time.perf_counter_ns()
+            tokens, error = lex(stream)
+            parse_start = time.perf_counter_ns()
+            if not error:
+                ast, error = build_ast(tokens, self.rng)
+            interpret_start = time.perf_counter_ns()
+            if error:
+                result = error
+                self.error_count += 1
+            else:
+                result = self.interpreter.interpret(ast)
+            end = time.perf_counter_ns()
+            self.elapsed += (end - lex_start) / 1e9
+            if error or ast:
+                self.statement_count += 1
+        timings = (parse_start - lex_start, interpret_start - parse_start, end - interpret_start)
+        return result, ast, timings
+
+    # Run several lines of source code one after another
+    # @param lines: The lines of source code to run
+    # @return: The list of results, one per line
+    def run_lines(self, lines):
+        with self.lock:
+            return [self.run(line) for line in lines]
+
+    # Run a batch of lines by parsing all of them first and interpreting the statements
+    # afterwards, optionally running the Optimizer in between. While a recorder is attached
+    # the lines are run one by one instead, so every line gets recorded.
+    # @param lines: The lines of source code to run
+    # @param optimize: Run the Optimizer over the statements before interpreting them
+    # @return: The list of results, one per line
+    def run_batch(self, lines, optimize=False):
+        with self.lock:
+            if self.recorder is not None:
+                return self.run_lines(lines)
+            start = time.perf_counter()
+            results = self.run_program(self.build_program(lines), optimize)
+            self.elapsed += time.perf_counter() - start
+            return results
+
+    # Parse a batch of lines into a program. Like run(), only the first statement of a line
+    # is kept, errors and blank lines are kept in place to preserve the result order.
+    # @param lines: The lines of source code to parse
+    # @return: The list of statements, errors and None for blank lines, one per line
+    def build_program(self, lines):
+        with self.lock:
+            program = []
+            for line in lines:
+                ast, error = parse(line, self.rng)
+                if error:
+                    program.append(error)
+                    self.error_count += 1
+                else:
+                    program.append(ast[0] if ast else None)
+                if error or ast:
+                    self.statement_count += 1
+            return program
+
+    # Interpret a program built by build_program
+    # @param program: The list of statements, errors and None for blank lines
+    # @param optimize: Run the Optimizer over the statements before interpreting them
+    # @return: The list of results, one per line
+    def run_program(self, program, optimize=False):
+        with self.lock:
+            if optimize:
+                program = self.optimizer.optimize(program)
+            results = []
+            for statement in program:
+                if isinstance(statement, DepositBatchNode):
+                    results.extend(self.interpreter.visit(statement))
+                elif isinstance(statement, Node):
+                    results.append(self.interpreter.visit(statement))
+                else:
+                    results.append(statement)
+            return results
+
+    # Estimate the memory held by the accounts of the session
+    # @return: The approximate size in bytes
+    def memory_usage(self):
+        accounts = self.account_table.accounts
+        size = sys.getsizeof(accounts)
+        for identifier, account in accounts.items():
+            size += sys.getsizeof(identifier) + sys.getsizeof(account)
+            for token in (account.firstname, account.lastname, account.balance):
+                size += sys.getsizeof(token) + sys.getsizeof(token.value)
+        return size
+
+    # Collect the statistics of the session
+    # @return: A dictionary with the account count, statement count, errors, fused
+    #          statements, elapsed time, throughput (statements per second) and memory usage
+    def stats(self):
+        with self.lock:
+            return {
+                "tenant_id": self.tenant_id,
+                "accounts": len(self.account_table.accounts),
+                "statements": self.statement_count,
+                "errors": self.error_count,
+                "fused": self.optimizer.fused_count,
+                "elapsed": self.elapsed,
+                "throughput": self.statement_count / self.elapsed if self.elapsed else 0.0,
+                "memory": self.memory_usage(),
+            }
+
+    def __repr__(self):
+        return f"Session({self.tenant_id}, {len(self.account_table.accounts)} accounts)"
+
+# =================================================================================================
+#    SESSION POOL
+#
+#    The SessionPool class is used to keep the sessions of many tenants in one process.
+#    Sessions are created on first use and the least recently used session is evicted
+#    once the pool holds more than max_sessions. A session is pinned while the pool runs
+#    work on it and a pinned session is never evicted, the pool grows past max_sessions
+#    instead and shrinks back once the work is done. The on_evict callback receives every
+#    evicted session so its account table can be saved before it is dropped, and the
+#    session_factory builds the session of a tenant that is not in the pool, so it can
+#    load a saved book back or give every tenant its own random number generator. Both
+#    are called with the pool lock held and must not call back into the pool.
+#
+#    run_concurrently interleaves independent tenants on a pool of worker threads. The
+#    interpreter is pure Python, so because of the GIL the threads do not run in parallel
+#    and do not add throughput for CPU bound batches. Use separate processes to spread
+#    tenants over several cores.
+#
+#    @param max_sessions: The maximum number of idle sessions to keep, unlimited if None
+#    @param max_workers: The number of worker threads used by run_concurrently
+#    @param on_evict: A function called with every evicted session, or None
+#    @param session_factory: A function building the Session of a tenant identifier,
+#                            Session(tenant_id) if None
+# =================================================================================================
+class SessionPool:
+    def __init__(self, max_sessions=None, max_workers=None, on_evict=None, session_factory=None):
+        self.max_sessions = max_sessions
+        self.max_workers = max_workers
+        self.on_evict = on_evict
+        self.session_factory = session_factory
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+        self.evicted_count = 0
+
+    # Get the session of a tenant, creating it if it does not exist yet. The session is
+    # not pinned, so it can be evicted as soon as other sessions are used. Use acquire and
+    # release to keep it in the pool while running work on it outside of run and
+    # run_concurrently.
+    # @param tenant_id: The identifier of the tenant
+    # @return: The session of the tenant
+    def get_session(self, tenant_id):
+        with self.lock:
+            session = self.load_session(tenant_id)
+            self.evict_overflow(keep=session)
+        return session
+
+    # Get the session of a tenant and pin it so it cannot be evicted
+    # @param tenant_id: The identifier of the tenant
+    # @return: The pinned session of the tenant
+    def acquire(self, tenant_id):
+        with self.lock:
+            session = self.load_session(tenant_id)
+            session.pin_count += 1
+        return session
+
+    # Unpin a session and evict the sessions that no longer fit in the pool
+    # @param session: The session returned by acquire
+    def release(self, session):
+        with self.lock:
+            session.pin_count -= 1
+            self.evict_overflow()
+
+    # Find the session of a tenant and mark it as most recently used. A missing session
+    # is built by session_factory (which can reload a book saved by on_evict) or created
+    # empty. Must be called with the pool lock held.
+    # @param tenant_id: The identifier of the tenant
+    # @return: The session of the tenant
+    def load_session(self, tenant_id):
+        session = self.sessions.get(tenant_id)
+        if session is None:
+            if self.session_factory is not None:
+                session = self.session_factory(tenant_id)
+            else:
+                session = Session(tenant_id)
+            self.sessions[tenant_id] = session
+        else:
+            self.sessions.move_to_end(tenant_id)
+        return session
+
+    # Evict the least recently used idle sessions until the pool fits max_sessions and pass
+    # them to on_evict. Must be called with the pool lock held, so a book is always saved
+    # by on_evict before session_factory can load it again.
+    # @param keep: A session that must not be evicted, or None
+    def evict_overflow(self, keep=None):
+        if self.max_sessions is None:
+            return
+        for tenant_id, session in list(self.sessions.items()):
+            if len(self.sessions) <= self.max_sessions:
+                break
+            if session.pin_count == 0 and session is not keep:
+                del self.sessions[tenant_id]
+                self.evicted_count += 1
+                if self.on_evict is not None:
+                    self.on_evict(session)
+
+    # Remove the session of a tenant from the pool and pass it to on_evict
+    # @param tenant_id: The identifier of the tenant
+    # @return: The evicted session, or None if the tenant had no session or it is still in use
+    def evict(self, tenant_id):
+        with self.lock:
+            session = self.sessions.get(tenant_id)
+            if session is None or session.pin_count > 0:
+                return None
+            del self.sessions[tenant_id]
+            self.evicted_count += 1
+            if self.on_evict is not None:
+                self.on_evict(session)
+        return session
+
+    # Run the source code in the session of a tenant
+    # @param tenant_id: The identifier of the tenant
+    # @param stream: The source code to run
+    # @return: The result of the statement or an error if one occurred
+    def run(self, tenant_id, stream):
+        session = self.acquire(tenant_id)
+        try:
+            return session.run(stream)
+        finally:
+            self.release(session)
+
+    # Run the lines of several tenants concurrently on the worker pool. Every session of
+    # the batch stays pinned until the whole batch is done. The threads only interleave
+    # the tenants, see the class description.
+    # @param jobs: A dictionary mapping tenant identifiers to lines of source code
+    # @param batch: Run the lines of every tenant with Session.run_batch instead of run_lines
+    # @param optimize: Run the Optimizer over the lines of every tenant, implies batch
+    # @return: A dictionary mapping tenant identifiers to their list of results
+    def run_concurrently(self, jobs, batch=False, optimize=False):
+        sessions = {tenant_id: self.acquire(tenant_id) for tenant_id in jobs}
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = {
+                    tenant_id: (
+                        executor.submit(sessions[tenant_id].run_batch, lines, optimize)
+                        if batch or optimize
+                        else executor.submit(sessions[tenant_id].run_lines, lines)
+                    )
+                    for tenant_id, lines in jobs.items()
+                }
+                return {tenant_id: future.result() for tenant_id, future in futures.items()}
+        finally:
+            for session in sessions.values():
+                self.release(session)
+
+    # Collect the statistics of every session in the pool
+    # @return: A list of session statistics, least recently used first
+    def stats(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+        return [session.stats() for session in sessions]
+
+    def __len__(self):
+        return len(self.sessions)
@@ -13,6 +13,10 @@
 # =================================================================================================
 
 import src.banking as banking
+import src.tracing as tracing
+import pytest
+import random
+from concurrent.futures import ThreadPoolExecutor
 import re
 
 def test_create_account():
@@ -77,4 +81,260 @@ def test_illegal_char_error_in_deposit():
     assert banking.run(syntax) == "Account created: JD123456"
     syntax = "DEPOSIT JD123456 1.0350.00"
     output = banking.run(syntax)
-    assert isinstance(output, banking.IllegalCharError)    
\ No newline at end of file
+    assert isinstance(output, banking.IllegalCharError)    
+
+def test_sessions_have_isolated_account_tables():
+    # Two tenants can use the same account number without seeing each other's balance.
+    first = banking.Session("first")
+    second = banking.Session("second")
+    assert first.run("CREATE FIRSTNAME John LASTNAME Doe BALANCE 1000 ACCOUNT JD123456") == "Account created: JD123456"
+    assert second.run("CREATE FIRSTNAME Jane LASTNAME Doe BALANCE 50 ACCOUNT JD123456") == "Account created: JD123456"
+    first.run("DEPOSIT JD123456 500")
+    assert first.run("BALANCE JD123456") == "Balance for account JD123456: $1500"
+    assert second.run("BALANCE JD123456") == "Balance for account JD123456: $50"
+    assert banking.Session().run("BALANCE JD123456") == "Account not found"
+
+def test_session_stats():
+    session = banking.Session("stats")
+    session.run_lines(["CREATE FIRSTNAME John LASTNAME Doe ACCOUNT JD123456", "", "%EPOSIT JD123456 1000"])
+    stats = session.stats()
+    assert stats["tenant_id"] == "stats"
+    assert stats["accounts"] == 1
+    assert stats["statements"] == 2
+    assert stats["errors"] == 1
+    assert stats["memory"] > 0
+
+def test_session_pool_evicts_least_recently_used():
+    pool = banking.SessionPool(max_sessions=2)
+    pool.run("a", "CREATE FIRSTNAME John LASTNAME Doe ACCOUNT JD123456")
+    pool.run("b", "CREATE FIRSTNAME John LASTNAME Doe ACCOUNT JD123456")
+    pool.get_session("a")
+    pool.run("c", "CREATE FIRSTNAME John LASTNAME Doe ACCOUNT JD123456")
+    assert list(pool.sessions) == ["a", "c"]
+    assert pool.evicted_count == 1
+    assert pool.evict("a").tenant_id == "a"
+    assert len(pool) == 1
+
+def test_session_pool_never_evicts_a_session_in_use():
+    evicted = []
+    pool = banking.SessionPool(max_sessions=1, on_evict=evicted.append)
+    busy = pool.acquire("busy")
+    pool.run("other", "CREATE FIRSTNAME John LASTNAME Doe ACCOUNT JD123456")
+    # The idle session is evicted even though it was used last
+    assert [session.tenant_id for session in evicted] == ["other"]
+    assert pool.evict("busy") is None
+    assert list(pool.sessions) == ["busy"]
+    pool.release(busy)
+    assert pool.evict("busy") is busy
+    assert [session.tenant_id for session in evicted] == ["other", "busy"]
+
+def test_session_pool_get_session_does_not_evict_the_returned_session():
+    pool = banking.SessionPool(max_sessions=1)
+    busy = pool.acquire("busy")
+    session = pool.get_session("x")
+    assert pool.sessions["x"] is session
+    session.run("CREATE FIRSTNAME John LASTNAME Doe ACCOUNT JD123456")
+    pool.release(busy)
+    assert pool.run("x", "BALANCE JD123456") == "Balance for account JD123456: $0"
+
+def test_session_pool_reloads_evicted_books_with_session_factory():
+    books = {}
+    created = []
+
+    def load(tenant_id):
+        if tenant_id in books:
+            return books.pop(tenant_id)
+        created.append(tenant_id)
+        return banking.Session(tenant_id, random.Random(tenant_id))
+
+    pool = banking.SessionPool(
+        max_sessions=1,
+        on_evict=lambda session: books.setdefault(session.tenant_id, session),
+        session_factory=load,
+    )
+    pool.run("a", "CREATE FIRSTNAME John LASTNAME Doe BALANCE 10 ACCOUNT JD123456")
+    pool.run("b", "CREATE FIRSTNAME Jane LASTNAME Roe ACCOUNT JR123456")
+    assert list(books) == ["a"]
+    assert pool.run("a", "BALANCE JD123456") == "Balance for account JD123456: $10"
+    assert list(books) == ["b"]
+    assert created == ["a", "b"]
+
+    # Every tenant gets its own seeded random number generator from the factory
+    expected = banking.Session(rng=random.Random("c")).run("CREATE FIRSTNAME John LASTNAME Doe")
+    assert pool.run("c", "CREATE FIRSTNAME John LASTNAME Doe") == expected
+
+def test_session_pool_run_concurrently_with_more_tenants_than_max_sessions():
+    evicted = []
+    pool = banking.SessionPool(max_sessions=2, max_workers=3, on_evict=evicted.append)
+    jobs = {
+        tenant: ["CREATE FIRSTNAME Ann LASTNAME Bell ACCOUNT AB123456", f"DEPOSIT AB123456 {tenant}"]
+        for tenant in range(3)
+    }
+    results = pool.run_concurrently(jobs)
+    for tenant in range(3):
+        assert results[tenant] == [
+            "Account created: AB123456",
+            f"Deposit of ${tenant} into account AB123456 successful",
+        ]
+    # The evicted book is handed to on_evict instead of being dropped silently
+    assert len(pool) == 2
+    assert len(evicted) == 1
+    assert evicted[0].tenant_id not in pool.sessions
+    assert evicted[0].run("BALANCE AB123456") == f"Balance for account AB123456: ${evicted[0].tenant_id}"
+
+def test_session_pool_run_concurrently():
+    pool = banking.SessionPool(max_workers=4)
+    jobs = {
+        tenant: [
+            "CREATE FIRSTNAME John LASTNAME Doe BALANCE 100 ACCOUNT JD123456",
+            f"DEPOSIT JD123456 {tenant}",
+            "BALANCE JD123456",
+        ]
+        for tenant in range(10)
+    }
+    results = pool.run_concurrently(jobs)
+    for tenant in range(10):
+        assert results[tenant][-1] == f"Balance for account JD123456: ${100 + tenant}"
+
+def test_seeded_sessions_generate_the_same_account_numbers():
+    first = banking.Session(rng=random.Random(42))
+    second = banking.Session(rng=random.Random(42))
+    syntax = "CREATE FIRSTNAME John LASTNAME Doe"
+    assert first.run(syntax) == second.run(syntax)
+
+def test_trace_record_and_replay(tmp_path):
+    path = tmp_path / "session.trace"
+    with tracing.TraceRecorder(path) as recorder:
+        created = recorder.run("CREATE FIRSTNAME John LASTNAME Doe BALANCE 100")
+        account = created.split(": ")[1]
+        recorder.run(f"DEPOSIT {account} 50")
+        recorder.run(f"WITHDRAW {account} 500")
+        recorder.run(f"BALANCE {account}")
+        recorder.run("%EPOSIT JD123456 1000")
+        recorder.run("")
+
+    records = tracing.read_trace(path)
+    assert [record.statement_type for record in records] == [
+        "CreateNode", "DepositNode", "WithdrawNode", "BalanceNode", "IllegalCharError", "Empty",
+    ]
+    assert records[0].generated_identifiers == [account]
+    assert records[3].result == f"Balance for account {account}: $150"
+
+    report = tracing.replay(path)
+    assert report.ok()
+    assert report.statement_count == 6
+    assert report.replayed_profile.entries["DepositNode"]["count"] == 1
+
+def test_trace_replay_detects_mismatches(tmp_path):
+    path = tmp_path / "session.trace"
+    with tracing.TraceRecorder(path) as recorder:
+        recorder.run("CREATE FIRSTNAME John LASTNAME Doe BALANCE 100 ACCOUNT JD123456")
+        recorder.run("BALANCE JD123456")
+
+    records = tracing.read_trace(path)
+    records[1].result = "Balance for account JD123456: $1"
+    with open(path, "wb") as file:
+        file.write(tracing.pack_header([]))
+        for record in records:
+            file.write(record.pack())
+
+    report = tracing.replay(path)
+    assert not report.ok()
+    assert report.mismatches[0][0] == 1
+
+def test_read_trace_rejects_other_files(tmp_path):
+    path = tmp_path / "not.trace"
+    path.write_bytes(b"hello world")
+    with pytest.raises(tracing.TraceError):
+        tracing.read_trace(path)
+
+BATCH = [
+    "CREATE FIRSTNAME John LASTNAME Doe BALANCE 100 ACCOUNT JD123456",
+    "CREATE FIRSTNAME Jane LASTNAME Roe ACCOUNT JR123456",
+    "DEPOSIT JD123456 0.1",
+    "DEPOSIT JD123456 0.2",
+    "DEPOSIT JD123456 0.3",
+    "DEPOSIT XX000000 10",
+    "DEPOSIT XX000000 10",
+    "",
+    "DEPOSIT JR123456 40",
+    "DEPOSIT JR123456 50",
+    "WITHDRAW JR123456 100",
+    "DEPOSIT JR123456 10",
+    "%EPOSIT JR123456 10",
+    "DEPOSIT JR123456 10",
+    "WITHDRAW JR123456 100",
+    "BALANCE JD123456",
+    "BALANCE JR123456",
+]
+
+def test_optimizer_fuses_consecutive_deposits_to_the_same_account():
+    program = [banking.parse(line)[0][0] for line in BATCH if line and not line.startswith("%")]
+    optimizer = banking.Optimizer()
+    optimized = optimizer.optimize(program)
+    assert optimizer.fused_count == 5
+    assert [type(statement).__name__ for statement in optimized] == [
+        "CreateNode", "CreateNode", "DepositBatchNode", "DepositBatchNode", "DepositBatchNode",
+        "WithdrawNode", "DepositBatchNode", "WithdrawNode", "BalanceNode", "BalanceNode",
+    ]
+
+def test_optimized_batch_matches_plain_run():
+    plain = banking.Session().run_lines(BATCH)
+    session = banking.Session()
+    assert [str(result) for result in banking.Session().run_batch(BATCH)] == [str(result) for result in plain]
+    optimized = session.run_batch(BATCH, optimize=True)
+    assert [str(result) for result in optimized] == [str(result) for result in plain]
+    assert optimized[10] == "Insufficient funds in account JR123456"
+    assert optimized[14] == "Withdrawal of $100 from account JR123456 successful"
+    assert optimized[5] == optimized[6] == "Account not found"
+    assert optimized[7] is None
+    assert isinstance(optimized[12], banking.IllegalCharError)
+    assert optimized[15] == plain[15] == f"Balance for account JD123456: ${100 + 0.1 + 0.2 + 0.3}"
+    assert session.stats()["fused"] == 4
+
+def test_trace_records_every_statement_run_on_the_session(tmp_path):
+    path = tmp_path / "session.trace"
+    session = banking.Session()
+    with tracing.TraceRecorder(path, session):
+        session.run("CREATE FIRSTNAME John LASTNAME Doe BALANCE 100 ACCOUNT JD123456")
+        session.run_batch(["DEPOSIT JD123456 1", "DEPOSIT JD123456 2"], optimize=True)
+        with pytest.raises(ValueError):
+            tracing.TraceRecorder(tmp_path / "other.trace", session)
+    assert session.recorder is None
+    session.run("BALANCE JD123456")
+
+    records = tracing.read_trace(path)
+    assert [record.statement_type for record in records] == ["CreateNode", "DepositNode", "DepositNode"]
+    assert tracing.replay(path).ok()
+
+def test_trace_keeps_statement_order_on_a_shared_session(tmp_path):
+    path = tmp_path / "session.trace"
+    session = banking.Session()
+    session.run("CREATE FIRSTNAME John LASTNAME Doe BALANCE 0 ACCOUNT JD123456")
+    jobs = [["DEPOSIT JD123456 1", "BALANCE JD123456"] * 50 for _ in range(4)]
+    with tracing.TraceRecorder(path, session):
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(lambda lines: [session.run(line) for line in lines], jobs))
+
+    records = tracing.read_trace(path)
+    balances = [record.result for record in records if record.statement_type == "BalanceNode"]
+    assert len(records) == 400
+    assert balances == sorted(balances, key=lambda result: int(result.split("$")[1]))
+    assert tracing.replay(path).ok()
+
+def test_trace_replays_a_session_that_already_had_accounts(tmp_path):
+    path = tmp_path / "session.trace"
+    session = banking.Session()
+    session.run("CREATE FIRSTNAME John LASTNAME Doe BALANCE 100 ACCOUNT JD123456")
+    session.run("CREATE FIRSTNAME Jane LASTNAME Roe BALANCE 0.5 ACCOUNT JR123456")
+    session.run("DEPOSIT JR123456 0.1")
+    with tracing.TraceRecorder(path, session):
+        session.run("DEPOSIT JD123456 50")
+        session.run("BALANCE JD123456")
+        session.run("BALANCE JR123456")
+
+    accounts, records = tracing.load_trace(path)
+    assert accounts == [("John", "Doe", "JD123456", 100), ("Jane", "Roe", "JR123456", 0.5 + 0.1)]
+    report = tracing.replay(path)
+    assert report.ok(), str(report)
+    assert report.statement_count == 3
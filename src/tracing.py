@@ -0,0 +1,434 @@
+# =================================================================================================
+#    Title:          Banking DSL Tracing
+#
+#    Description:    This module is used to record the statements run by a session to a
+#                    compact binary trace file and to replay a trace deterministically
+#                    against a fresh account table.
+#
+#    Authors:        Norlander, Robert       (Primary)
+#                    Koenigsfeld, Jarod      (Debugging)
+#                    Salamonska, Aleksandra  (Documentation)
+#
+#    Class:          CSC 330-100 Language Design and Implementation
+#    Date:           2024-04-28
+#    Version:        1.0
+# =================================================================================================
+
+import random
+import struct
+import src.banking as banking
+
+# =================================================================================================
+#    TRACE FORMAT
+#
+#    A trace file starts with a header made of the magic bytes and the format version,
+#    followed by a snapshot of the accounts the session held when recording started: the
+#    account count, then per account the lengths of the first name, last name, account
+#    identifier and balance text and whether the balance is a float, followed by the texts.
+#    It is followed by one record per statement. A record starts with a fixed size
+#    header (result kind, generated account count, statement type, source and result
+#    lengths and the lex, parse and interpret timings in nanoseconds) followed by the
+#    statement type, the source, the result and the generated account identifiers.
+#    All integers are little-endian.
+# =================================================================================================
+TRACE_MAGIC = b"BNKT"
+TRACE_VERSION = 2
+TRACE_HEADER = struct.Struct("<4sH")
+SNAPSHOT_HEADER = struct.Struct("<I")
+ACCOUNT_HEADER = struct.Struct("<HHHHB")
+RECORD_HEADER = struct.Struct("<BBBIIQQQ")
+IDENTIFIER_LENGTH = struct.Struct("<B")
+
+RESULT_NONE = 0
+RESULT_STR = 1
+RESULT_ERROR = 2
+
+# =================================================================================================
+#    TraceError is raised when a trace file cannot be read
+#
+#    @param details: The details of the error
+# =================================================================================================
+class TraceError(Exception):
+    def __init__(self, details):
+        super().__init__(f"Invalid Trace: {details}")
+
+# =================================================================================================
+#    TRACE RECORD
+#
+#    The TraceRecord class is used to represent a single statement of a trace.
+#
+#    @param statement_type: The name of the node (or error) the statement produced
+#    @param stream: The source code of the statement
+#    @param generated_identifiers: The account identifiers generated while parsing
+#    @param result_kind: RESULT_NONE, RESULT_STR or RESULT_ERROR
+#    @param result: The result text of the statement
+#    @param timings: A (lex, parse, interpret) tuple of nanoseconds
+# =================================================================================================
+class TraceRecord:
+    def __init__(self, statement_type, stream, generated_identifiers, result_kind, result, timings):
+        self.statement_type = statement_type
+        self.stream = stream
+        self.generated_identifiers = generated_identifiers
+        self.result_kind = result_kind
+        self.result = result
+        self.timings = timings
+
+    # Build a record from the outcome of Session.execute
+    # @return: The trace record
+    @classmethod
+    def from_execution(cls, stream, result, ast, timings):
+        generated_identifiers = [
+            node.account_identifier.value
+            for node in ast
+            if isinstance(node, banking.CreateNode) and node.generated_identifier
+        ]
+        result_kind, result_text = encode_result(result)
+        return cls(statement_type(result, ast), stream, generated_identifiers, result_kind, result_text, timings)
+
+    # Serialize the record
+    # @return: The bytes of the record
+    def pack(self):
+        statement_type = self.statement_type.encode()
+        stream = self.stream.encode()
+        result = self.result.encode()
+        parts = [
+            RECORD_HEADER.pack(
+                self.result_kind,
+                len(self.generated_identifiers),
+                len(statement_type),
+                len(stream),
+                len(result),
+                *self.timings,
+            ),
+            statement_type,
+            stream,
+            result,
+        ]
+        for identifier in self.generated_identifiers:
+            identifier = identifier.encode()
+            parts.append(IDENTIFIER_LENGTH.pack(len(identifier)))
+            parts.append(identifier)
+        return b"".join(parts)
+
+    def __repr__(self):
+        return f"TraceRecord({self.statement_type}, {self.stream!r}, {self.result!r})"
+
+# Get the name of the statement type from the outcome of a statement
+# @param result: The result of the statement
+# @param ast: The AST of the statement
+# @return: The node name, the error name or "Empty" for blank lines
+def statement_type(result, ast):
+    if isinstance(result, banking.Error):
+        return type(result).__name__
+    if ast:
+        return type(ast[0]).__name__
+    return "Empty"
+
+# Split a result into its kind and text
+# @param result: The result of a statement
+# @return: The result kind and the result text
+def encode_result(result):
+    if result is None:
+        return RESULT_NONE, ""
+    if isinstance(result, banking.Error):
+        return RESULT_ERROR, str(result)
+    return RESULT_STR, str(result)
+
+# =================================================================================================
+#    SNAPSHOT
+#
+#    The snapshot functions are used to save the accounts of an account table at the start
+#    of a trace and to load them into the account table of the replay session.
+# =================================================================================================
+
+# Take a snapshot of the accounts of an account table
+# @param account_table: The account table
+# @return: A list of (first name, last name, account identifier, balance) tuples
+def snapshot_accounts(account_table):
+    return [
+        (str(account.firstname.value), str(account.lastname.value), identifier, account.balance.value)
+        for identifier, account in account_table.accounts.items()
+    ]
+
+# Add the accounts of a snapshot to an account table
+# @param account_table: The account table
+# @param accounts: The snapshot of the accounts
+def restore_accounts(account_table, accounts):
+    for firstname, lastname, identifier, balance in accounts:
+        balance_type = banking.TokenType.TT_FLOAT if isinstance(balance, float) else banking.TokenType.TT_INT
+        account_table.add_account(
+            banking.CreateNode(
+                banking.Token(banking.TokenType.TT_STR, firstname),
+                banking.Token(banking.TokenType.TT_STR, lastname),
+                banking.Token(balance_type, balance),
+                banking.Token(banking.TokenType.TT_STR, identifier),
+            )
+        )
+
+# Serialize the header and the snapshot of the accounts
+# @param accounts: The snapshot of the accounts
+# @return: The bytes starting a trace file
+def pack_header(accounts):
+    parts = [TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION), SNAPSHOT_HEADER.pack(len(accounts))]
+    for firstname, lastname, identifier, balance in accounts:
+        texts = [firstname.encode(), lastname.encode(), identifier.encode(), repr(balance).encode()]
+        parts.append(ACCOUNT_HEADER.pack(*(len(text) for text in texts), isinstance(balance, float)))
+        parts.extend(texts)
+    return b"".join(parts)
+
+# =================================================================================================
+#    TRACE RECORDER
+#
+#    The TraceRecorder class is used to run statements in a session and write every
+#    statement, the account identifiers it generated, its result and its stage timings
+#    to a binary trace file. Records are written to a buffered file as they are run.
+#
+#    The recorder attaches itself to the session, so statements run through Session.run,
+#    Session.run_lines and Session.run_batch are recorded too, and run_batch runs the lines
+#    one by one while the session is recorded. Session.execute bypasses the recorder. Every record is written
+#    while the session lock is held, so the records keep the order the statements ran in
+#    even when the session is shared between threads. The accounts the session already
+#    holds are saved at the start of the trace so the replay starts from the same book.
+#
+#    @param path: The path of the trace file to write
+#    @param session: The session to run the statements in, a new one by default
+# =================================================================================================
+class TraceRecorder:
+    def __init__(self, path, session=None):
+        self.session = session if session is not None else banking.Session()
+        with self.session.lock:
+            if self.session.recorder is not None:
+                raise ValueError("The session is already being recorded")
+            self.file = open(path, "wb")
+            self.file.write(pack_header(snapshot_accounts(self.session.account_table)))
+            self.session.recorder = self
+        self.record_count = 0
+
+    # Run the source code and record it
+    # @param stream: The source code to run
+    # @return: The result of the statement or an error if one occurred
+    def run(self, stream):
+        with self.session.lock:
+            result, ast, timings = self.session.execute(stream)
+            self.file.write(TraceRecord.from_execution(stream, result, ast, timings).pack())
+            self.record_count += 1
+        return result
+
+    # Detach from the session, then flush and close the trace file
+    def close(self):
+        with self.session.lock:
+            if self.session.recorder is self:
+                self.session.recorder = None
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# =================================================================================================
+#    READ TRACE
+#
+#    The read_trace function is used to read the records of a trace file.
+#    @param path: The path of the trace file to read
+#    @return: The list of trace records
+# =================================================================================================
+def read_trace(path):
+    accounts, records = load_trace(path)
+    return records
+
+# =================================================================================================
+#    LOAD TRACE
+#
+#    The load_trace function is used to read the account snapshot and the records of a
+#    trace file.
+#    @param path: The path of the trace file to read
+#    @return: The snapshot of the starting accounts and the list of trace records
+# =================================================================================================
+def load_trace(path):
+    with open(path, "rb") as file:
+        data = file.read()
+
+    if len(data) < TRACE_HEADER.size:
+        raise TraceError("File is too short to be a trace")
+    magic, version = TRACE_HEADER.unpack_from(data, 0)
+    if magic != TRACE_MAGIC:
+        raise TraceError("File is not a banking trace")
+    if version != TRACE_VERSION:
+        raise TraceError(f"Unsupported trace version {version}")
+
+    accounts = []
+    offset = TRACE_HEADER.size
+    try:
+        (account_count,) = SNAPSHOT_HEADER.unpack_from(data, offset)
+        offset += SNAPSHOT_HEADER.size
+        for _ in range(account_count):
+            *lengths, is_float = ACCOUNT_HEADER.unpack_from(data, offset)
+            offset += ACCOUNT_HEADER.size
+            texts = []
+            for length in lengths:
+                texts.append(data[offset:offset + length].decode())
+                offset += length
+            if offset > len(data):
+                raise struct.error("account extends past the end of the file")
+            firstname, lastname, identifier, balance = texts
+            accounts.append((firstname, lastname, identifier, float(balance) if is_float else int(balance)))
+    except (struct.error, UnicodeDecodeError, ValueError):
+        raise TraceError("Truncated or corrupt account snapshot")
+
+    records = []
+    try:
+        while offset < len(data):
+            (
+                result_kind,
+                identifier_count,
+                type_length,
+                stream_length,
+                result_length,
+                *timings,
+            ) = RECORD_HEADER.unpack_from(data, offset)
+            offset += RECORD_HEADER.size
+            statement_type_name = data[offset:offset + type_length].decode()
+            offset += type_length
+            stream = data[offset:offset + stream_length].decode()
+            offset += stream_length
+            result = data[offset:offset + result_length].decode()
+            offset += result_length
+            generated_identifiers = []
+            for _ in range(identifier_count):
+                (length,) = IDENTIFIER_LENGTH.unpack_from(data, offset)
+                offset += IDENTIFIER_LENGTH.size
+                generated_identifiers.append(data[offset:offset + length].decode())
+                offset += length
+            if offset > len(data):
+                raise struct.error("record extends past the end of the file")
+            records.append(
+                TraceRecord(statement_type_name, stream, generated_identifiers, result_kind, result, tuple(timings))
+            )
+    except (struct.error, UnicodeDecodeError):
+        raise TraceError(f"Truncated or corrupt record {len(records)}")
+    return accounts, records
+
+# =================================================================================================
+#    REPLAY RANDOM
+#
+#    The ReplayRandom class is used in place of a random number generator during
+#    replay. It hands out the digits of the recorded account identifiers so that
+#    generated account numbers match the trace exactly. Once the recorded digits
+#    run out it falls back to a seeded generator so the replay stays deterministic.
+# =================================================================================================
+class ReplayRandom:
+    def __init__(self):
+        self.pending = []
+        self.fallback = random.Random(0)
+
+    # Queue the recorded identifiers of the next statement
+    # @param identifiers: The generated account identifiers of the statement
+    def feed(self, identifiers):
+        self.pending = [int(identifier[2:]) for identifier in identifiers]
+
+    def randint(self, a, b):
+        if self.pending:
+            return self.pending.pop(0)
+        return self.fallback.randint(a, b)
+
+# =================================================================================================
+#    PROFILE
+#
+#    The Profile class is used to accumulate the stage timings per statement type.
+# =================================================================================================
+class Profile:
+    def __init__(self):
+        self.entries = {}
+
+    # Add the timings of a statement
+    # @param statement_type: The statement type
+    # @param timings: A (lex, parse, interpret) tuple of nanoseconds
+    def add(self, statement_type, timings):
+        entry = self.entries.setdefault(
+            statement_type, {"count": 0, "lex": 0, "parse": 0, "interpret": 0}
+        )
+        entry["count"] += 1
+        entry["lex"] += timings[0]
+        entry["parse"] += timings[1]
+        entry["interpret"] += timings[2]
+
+    # Build the profile of the timings recorded in a trace
+    # @param records: The trace records
+    # @return: The profile
+    @classmethod
+    def from_records(cls, records):
+        profile = cls()
+        for record in records:
+            profile.add(record.statement_type, record.timings)
+        return profile
+
+    def __str__(self):
+        lines = [f"{'Statement':<20}{'Count':>8}{'Lex us':>12}{'Parse us':>12}{'Interpret us':>14}"]
+        for name, entry in sorted(self.entries.items()):
+            count = entry["count"]
+            lines.append(
+                f"{name:<20}{count:>8}"
+                f"{entry['lex'] / count / 1000:>12.2f}"
+                f"{entry['parse'] / count / 1000:>12.2f}"
+                f"{entry['interpret'] / count / 1000:>14.2f}"
+            )
+        return "\n".join(lines)
+
+# =================================================================================================
+#    REPLAY REPORT
+#
+#    The ReplayReport class is used to hold the outcome of a replay: the number of
+#    statements replayed, the statements whose result did not match the trace and
+#    the recorded and replayed timing profiles.
+# =================================================================================================
+class ReplayReport:
+    def __init__(self, records):
+        self.statement_count = len(records)
+        self.mismatches = []
+        self.recorded_profile = Profile.from_records(records)
+        self.replayed_profile = Profile()
+
+    # Check if every replayed result matched the trace
+    # @return: True if no mismatches were found
+    def ok(self):
+        return not self.mismatches
+
+    def __str__(self):
+        lines = [f"Replayed {self.statement_count} statements, {len(self.mismatches)} mismatches"]
+        for index, record, actual in self.mismatches:
+            lines.append(f"  #{index} {record.stream.strip()!r}: expected {record.result!r}, got {actual!r}")
+        lines.append("")
+        lines.append("Recorded profile:")
+        lines.append(str(self.recorded_profile))
+        lines.append("")
+        lines.append("Replayed profile:")
+        lines.append(str(self.replayed_profile))
+        return "\n".join(lines)
+
+# =================================================================================================
+#    REPLAY
+#
+#    The replay function is used to run the statements of a trace against a fresh
+#    account table holding the snapshot of the starting accounts, check that every
+#    result matches and profile the run.
+#    @param path: The path of the trace file to replay
+#    @return: The replay report
+# =================================================================================================
+def replay(path):
+    accounts, records = load_trace(path)
+    report = ReplayReport(records)
+    rng = ReplayRandom()
+    session = banking.Session("replay", rng)
+    restore_accounts(session.account_table, accounts)
+
+    for index, record in enumerate(records):
+        rng.feed(record.generated_identifiers)
+        result, ast, timings = session.execute(record.stream)
+        report.replayed_profile.add(statement_type(result, ast), timings)
+        result_kind, result_text = encode_result(result)
+        if result_kind != record.result_kind or result_text != record.result:
+            report.mismatches.append((index, record, result_text))
+
+    return report